@@ -1,27 +1,21 @@
 import asyncio
+import bisect
 import logging
 import os
 import random
-import sqlite3
-import pandas as pd
-import csv
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
-
-from fpdf import FPDF
+import tempfile
 
+import aiosqlite
 from prettytable import PrettyTable
-from typing import List
+from typing import Dict, List, Optional
 
-from aiogram import Bot, Dispatcher, Router, types
+from aiogram import Bot, Dispatcher, F, Router, types
 from aiogram.client.default import DefaultBotProperties
 from aiogram.filters import Command
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.types import BufferedInputFile, FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram import BaseMiddleware
 from dotenv import load_dotenv
 
@@ -43,7 +37,7 @@ if TELEGRAM_BOT_TOKEN is None:
 ALLOWED_USERS_ENV = os.environ.get("TELEGRAM_ALLOWED_USERS")
 if ALLOWED_USERS_ENV is None:
     raise ValueError("TELEGRAM_ALLOWED_USERS не задан в переменных окружения.")
-ALLOWED_USERS = set(int(user.strip()) for user in ALLOWED_USERS_ENV.split(','))
+ALLOWED_USERS = frozenset(int(user.strip()) for user in ALLOWED_USERS_ENV.split(','))
 
 DATABASE_FILE = "bot_data.db"
 
@@ -51,84 +45,101 @@ class DatabaseManager:
     """
     Обрабатывает операции с базой данных, в том числе инициализацию, хранение списка учащихся,
     а также историю сгенерированных расписаний.
+    Использует одно долгоживущее соединение aiosqlite, запросы выполняются в его рабочем потоке.
     """
     def __init__(self, db_file: str = DATABASE_FILE) -> None:
-        self.conn = sqlite3.connect(db_file, check_same_thread=False)
-        self.init_db()
-
-    def init_db(self) -> None:
-        cursor = self.conn.cursor()
+        self.db_file = db_file
+        self.conn: Optional[aiosqlite.Connection] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+
+    async def connect(self) -> None:
+        # Соединение общее, поэтому записи сериализуются, чтобы не попасть в чужую транзакцию.
+        # Блокировка создается здесь, чтобы быть привязанной к работающему циклу событий.
+        self._write_lock = asyncio.Lock()
+        # Автокоммит: транзакции открываются явно там, где они нужны.
+        self.conn = await aiosqlite.connect(self.db_file, isolation_level=None)
+        await self.init_db()
+
+    async def close(self) -> None:
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+
+    async def init_db(self) -> None:
+        # WAL позволяет читать параллельно с записью и не делать fsync журнала на каждый коммит.
+        await self.conn.execute("PRAGMA journal_mode=WAL")
+        await self.conn.execute("PRAGMA synchronous=NORMAL")
+        await self.conn.execute("PRAGMA temp_store=MEMORY")
+        await self.conn.execute("PRAGMA cache_size=-64000")
+        await self.conn.execute("PRAGMA mmap_size=268435456")
         # Таблица для хранения списка учащихся.
-        cursor.execute("""
+        await self.conn.execute("""
             CREATE TABLE IF NOT EXISTS students (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 surname TEXT UNIQUE NOT NULL
             )
         """)
         # Таблица для хранения истории расписаний.
-        cursor.execute("""
+        await self.conn.execute("""
             CREATE TABLE IF NOT EXISTS schedule_history (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 schedule TEXT NOT NULL,
                 generated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
-        self.conn.commit()
 
-    def get_all_students(self) -> List[str]:
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT surname FROM students ORDER BY surname ASC")
-        rows = cursor.fetchall()
+    async def get_all_students(self) -> List[str]:
+        async with self.conn.execute("SELECT surname FROM students ORDER BY surname ASC") as cursor:
+            rows = await cursor.fetchall()
         return [row[0] for row in rows]
 
-    def add_students(self, surnames: List[str]) -> None:
-        cursor = self.conn.cursor()
-        for surname in surnames:
+    async def add_students(self, surnames: List[str]) -> None:
+        async with self._write_lock:
+            await self.conn.execute("BEGIN")
             try:
-                cursor.execute("INSERT INTO students (surname) VALUES (?)", (surname,))
-            except sqlite3.IntegrityError:
-                pass
-        self.conn.commit()
-
-    def remove_student(self, surname: str) -> bool:
-        cursor = self.conn.cursor()
-        cursor.execute("DELETE FROM students WHERE surname = ?", (surname,))
-        self.conn.commit()
-        return cursor.rowcount > 0
-
-    def add_schedule_history(self, schedule: str) -> None:
-        cursor = self.conn.cursor()
-        cursor.execute("INSERT INTO schedule_history (schedule) VALUES (?)", (schedule,))
-        self.conn.commit()
+                await self.conn.executemany(
+                    "INSERT OR IGNORE INTO students (surname) VALUES (?)",
+                    [(surname,) for surname in surnames]
+                )
+            except Exception:
+                await self.conn.execute("ROLLBACK")
+                raise
+            await self.conn.execute("COMMIT")
+
+    async def remove_student(self, surname: str) -> bool:
+        async with self._write_lock:
+            async with self.conn.execute("DELETE FROM students WHERE surname = ?", (surname,)) as cursor:
+                return cursor.rowcount > 0
+
+    async def add_schedule_history(self, schedule: str) -> None:
+        async with self._write_lock:
+            await self.conn.execute("INSERT INTO schedule_history (schedule) VALUES (?)", (schedule,))
 
 db_manager = DatabaseManager()
-if not db_manager.get_all_students():
-    initial_students = [
-        "Атаманова", "Бабенков", "Бендусов", "Вертакова", "Выродова",
-        "Герасимова", "Гиренко", "Иванов", "Киртока", "Ковалёва",
-        "Коновалов", "Куликова", "Минаева", "Митюшин", "Мурашова",
-        "Мягкова", "Номашко", "Петрова", "Романова-Саваренская", 
-        "Сигарёв", "Соколов", "Солдатова", "Соловьёв", "Трошин",
-        "Ходунова", "Черняев", "Чуб", "Шалаев", "Шубин"
-    ]
-    db_manager.add_students(initial_students)
+
+INITIAL_STUDENTS = [
+    "Атаманова", "Бабенков", "Бендусов", "Вертакова", "Выродова",
+    "Герасимова", "Гиренко", "Иванов", "Киртока", "Ковалёва",
+    "Коновалов", "Куликова", "Минаева", "Митюшин", "Мурашова",
+    "Мягкова", "Номашко", "Петрова", "Романова-Саваренская", 
+    "Сигарёв", "Соколов", "Солдатова", "Соловьёв", "Трошин",
+    "Ходунова", "Черняев", "Чуб", "Шалаев", "Шубин"
+]
 
 class AllowedUsersMiddleware(BaseMiddleware):
     """
     Middleware для проверки, что пользователь входит в список разрешенных.
     Если нет, дальнейшая обработка сообщения прекращается.
+    Регистрируется только для сообщений и callback-запросов.
     """
     async def __call__(self, handler, event, data):
-        user = None
-        if hasattr(event, "from_user") and event.from_user:
-            user = event.from_user
-        elif hasattr(event, "message") and event.message and event.message.from_user:
-            user = event.message.from_user
-        if user and user.id not in ALLOWED_USERS:
-            if isinstance(event, types.Message):
-                await event.reply("Access denied.")
-            elif isinstance(event, types.CallbackQuery):
+        # Пользователь уже извлечен из события встроенным UserContextMiddleware.
+        user = data.get("event_from_user")
+        if user is not None and user.id not in ALLOWED_USERS:
+            if isinstance(event, types.CallbackQuery):
                 await event.answer("Access denied.", show_alert=True)
+            else:
+                await event.reply("Access denied.")
             return
         return await handler(event, data)
 
@@ -142,27 +153,59 @@ class GlobalErrorHandler(BaseMiddleware):
             return await handler(event, data)
         except Exception as e:
             logging.exception("Необработанная ошибка: %s", e)
-            if isinstance(event, types.Message):
-                await event.reply("Произошла ошибка, попробуйте позже.")
-            elif isinstance(event, types.CallbackQuery):
+            if isinstance(event, types.CallbackQuery):
                 await event.answer("Произошла ошибка, попробуйте позже.", show_alert=True)
+            else:
+                await event.reply("Произошла ошибка, попробуйте позже.")
             return
 
 class StudentSurnames:
     """
     Класс для управления списком фамилий учащихся с сохранением их в базе данных.
+    Держит отсортированную копию списка в памяти; база данных остается источником истины.
     """
-    def get_all(self) -> List[str]:
-        return db_manager.get_all_students()
+    def __init__(self) -> None:
+        self._cache: List[str] = []
+        self._lock: Optional[asyncio.Lock] = None
 
-    def add(self, new_students: List[str]) -> None:
-        db_manager.add_students(new_students)
+    async def load(self) -> None:
+        # Блокировка создается на работающем цикле событий, а не при импорте модуля.
+        self._lock = asyncio.Lock()
+        self._cache = await db_manager.get_all_students()
+        invalidate_students_keyboard()
 
-    def remove(self, student: str) -> bool:
-        return db_manager.remove_student(student)
+    def get_all(self) -> List[str]:
+        return self._cache
+
+    async def add(self, new_students: List[str]) -> None:
+        async with self._lock:
+            await db_manager.add_students(new_students)
+            invalidate_students_keyboard()
+            for student in new_students:
+                index = bisect.bisect_left(self._cache, student)
+                if index == len(self._cache) or self._cache[index] != student:
+                    self._cache.insert(index, student)
+
+    async def remove(self, student: str) -> bool:
+        async with self._lock:
+            removed = await db_manager.remove_student(student)
+            if removed:
+                invalidate_students_keyboard(student)
+                if student in self._cache:
+                    self._cache.remove(student)
+            return removed
 
 STUDENTS = StudentSurnames()
 
+async def init_storage() -> None:
+    """
+    Открывает базу данных, заполняет начальный список учащихся и загружает его в память.
+    """
+    await db_manager.connect()
+    if not await db_manager.get_all_students():
+        await db_manager.add_students(INITIAL_STUDENTS)
+    await STUDENTS.load()
+
 class ScheduleGenerator:
     """
     Генерирует расписание, распределяя участников по этажам и секциям.
@@ -177,6 +220,7 @@ class ScheduleGenerator:
         self.places: List[str] = places
         self.num_floors: int = num_floors
         self.sections: List[List[str]] = [[] for _ in range(len(self.places))]
+        self._grid: Optional[List[List[str]]] = None
         self.table = PrettyTable()
         self.table.field_names = ['Этаж'] + self.places
         self.table.hrules = True
@@ -185,42 +229,41 @@ class ScheduleGenerator:
         random.shuffle(self.surnames)
 
     def distribute_participants(self) -> None:
-        for i, surname in enumerate(self.surnames):
-            self.sections[i % len(self.places)].append(surname)
-
-    def create_schedule(self) -> None:
+        num_places = len(self.places)
+        self.sections = [self.surnames[i::num_places] for i in range(num_places)]
+        self._grid = None
+
+    def _build_grid(self) -> List[List[str]]:
+        """
+        Формирует строки таблицы (этаж и ячейки секций) один раз для таблицы и Excel.
+        """
+        if self._grid is not None:
+            return self._grid
         total_cells = self.num_floors * len(self.places)
         participants_per_cell = len(self.surnames) // total_cells if total_cells > 0 else 0
+        grid: List[List[str]] = []
         for floor in range(self.num_floors):
+            start_index = floor * participants_per_cell
+            end_index = start_index + participants_per_cell
             row: List[str] = [f"{floor + 1}"]
-            for i in range(len(self.places)):
-                start_index = floor * participants_per_cell
-                end_index = start_index + participants_per_cell
-                participants = self.sections[i][start_index:end_index]
-                cell_text = '\n'.join(participants) if participants else 'Нет участников'
-                row.append(cell_text)
-            self.table.add_row(row)
+            for section in self.sections:
+                participants = section[start_index:end_index]
+                row.append('\n'.join(participants) if participants else 'Нет участников')
+            grid.append(row)
+        self._grid = grid
+        return grid
+
+    def create_schedule(self) -> None:
+        self.table.add_rows(self._build_grid())
 
     def save_to_excel(self, filename: str) -> None:
-        total_cells = self.num_floors * len(self.places)
-        participants_per_cell = len(self.surnames) // total_cells if total_cells > 0 else 0
-        data = {'Этаж': [f"{floor + 1}" for floor in range(self.num_floors)]}
-        for i, place in enumerate(self.places):
-            col_data: List[str] = []
-            for floor in range(self.num_floors):
-                start_index = floor * participants_per_cell
-                end_index = start_index + participants_per_cell
-                participants = self.sections[i][start_index:end_index]
-                cell_text = '\n'.join(participants) if participants else 'Нет участников'
-                col_data.append(cell_text)
-            data[place] = col_data
-        df = pd.DataFrame(data)
-        column_order = ['Этаж'] + self.places
-        df = df[column_order]
-        with pd.ExcelWriter(filename, engine='xlsxwriter') as writer:
-            df.to_excel(writer, index=False, sheet_name='Schedule')
-            workbook = writer.book
-            worksheet = writer.sheets['Schedule']
+        # Импорт откладывается до первого /schedule, чтобы не замедлять запуск бота.
+        import xlsxwriter
+        header: List[str] = ['Этаж'] + self.places
+        rows = self._build_grid()
+        workbook = xlsxwriter.Workbook(filename)
+        try:
+            worksheet = workbook.add_worksheet('Schedule')
             header_format = workbook.add_format({
                 'bold': True,
                 'font_color': 'white',
@@ -230,11 +273,6 @@ class ScheduleGenerator:
                 'align': 'center',
                 'border': 1
             })
-            for col_num, value in enumerate(df.columns.values):
-                worksheet.write(0, col_num, value, header_format)
-                series = df[value].astype(str)
-                max_len = max(series.map(len).max(), len(value)) + 2
-                worksheet.set_column(col_num, col_num, max_len)
             cell_format = workbook.add_format({
                 'border': 1,
                 'align': 'center',
@@ -242,25 +280,28 @@ class ScheduleGenerator:
                 'text_wrap': True,
                 'bg_color': '#F2F2F2'
             })
-            for row_num in range(1, len(df) + 1):
-                if row_num % 2 == 0:
-                    row_format = workbook.add_format({
-                        'border': 1,
-                        'align': 'center',
-                        'valign': 'vcenter',
-                        'text_wrap': True,
-                        'bg_color': '#E7E6E6'
-                    })
-                else:
-                    row_format = cell_format
-                for col_num in range(len(df.columns)):
-                    worksheet.write(row_num, col_num, df.iat[row_num-1, col_num], row_format)
-
-def store_schedule_history(schedule_text: str) -> None:
+            even_format = workbook.add_format({
+                'border': 1,
+                'align': 'center',
+                'valign': 'vcenter',
+                'text_wrap': True,
+                'bg_color': '#E7E6E6'
+            })
+            for col_num, value in enumerate(header):
+                max_len = max([len(value)] + [len(row[col_num]) for row in rows]) + 2
+                worksheet.set_column(col_num, col_num, max_len)
+            worksheet.write_row(0, 0, header, header_format)
+            row_formats = (even_format, cell_format)
+            for row_num, row in enumerate(rows, start=1):
+                worksheet.write_row(row_num, 0, row, row_formats[row_num % 2])
+        finally:
+            workbook.close()
+
+async def store_schedule_history(schedule_text: str) -> None:
     """
     Сохраняет сгенерированное расписание в базу данных.
     """
-    db_manager.add_schedule_history(schedule_text)
+    await db_manager.add_schedule_history(schedule_text)
 
 class StudentUpdate(StatesGroup):
     adding_students = State()
@@ -308,44 +349,69 @@ async def schedule_command(message: types.Message):
     generator.shuffle_surnames()
     generator.distribute_participants()
     generator.create_schedule()
-    schedule_text = f"<pre>{generator.table.get_string()}</pre>"
-    await message.reply(schedule_text, parse_mode="HTML")
-    excel_filename = "schedule.xlsx"
-    generator.save_to_excel(excel_filename)
-    store_schedule_history(generator.table.get_string())
-    document = FSInputFile(excel_filename)
-    await message.reply_document(document=document, caption="Расписание в Excel формате.")
+    table_str = generator.table.get_string()
+    schedule_text = f"<pre>{table_str}</pre>"
+    if len(schedule_text) > 4000:
+        # Telegram не принимает сообщения длиннее 4096 символов.
+        document = BufferedInputFile(table_str.encode("utf-8"), filename="schedule.txt")
+        await message.reply_document(document=document, caption="Расписание в виде таблицы.")
+    else:
+        await message.reply(schedule_text, parse_mode="HTML")
+    with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as tmp_file:
+        excel_filename = tmp_file.name
+    try:
+        await asyncio.to_thread(generator.save_to_excel, excel_filename)
+        await store_schedule_history(table_str)
+        document = FSInputFile(excel_filename, filename="schedule.xlsx")
+        await message.reply_document(document=document, caption="Расписание в Excel формате.")
+    finally:
+        os.unlink(excel_filename)
+
+_keyboard_cache: Optional[InlineKeyboardMarkup] = None
+_confirm_keyboard_cache: Dict[str, InlineKeyboardMarkup] = {}
+
+def invalidate_students_keyboard(student: Optional[str] = None) -> None:
+    """
+    Сбрасывает закэшированную клавиатуру после изменения списка учащихся.
+    """
+    global _keyboard_cache
+    _keyboard_cache = None
+    if student is not None:
+        _confirm_keyboard_cache.pop(student, None)
 
 def build_students_keyboard() -> InlineKeyboardMarkup:
-    keyboard = []
-    current_students = STUDENTS.get_all()
-    row = []
-    for idx, student in enumerate(current_students):
-        button = InlineKeyboardButton(text=f"Удалить: {student}", callback_data=f"delete:{student}")
-        row.append(button)
-        if len(row) == 2:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
+    global _keyboard_cache
+    if _keyboard_cache is not None:
+        return _keyboard_cache
+    buttons = [
+        InlineKeyboardButton(text=f"Удалить: {student}", callback_data=f"delete:{student}")
+        for student in STUDENTS.get_all()
+    ]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
     keyboard.append([InlineKeyboardButton(text="Добавить ученика", callback_data="add_student")])
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+    _keyboard_cache = InlineKeyboardMarkup(inline_keyboard=keyboard)
+    return _keyboard_cache
 
 def build_confirm_deletion_keyboard(student: str) -> InlineKeyboardMarkup:
+    cached = _confirm_keyboard_cache.get(student)
+    if cached is not None:
+        return cached
     keyboard = [
         [
             InlineKeyboardButton(text="Подтвердить", callback_data=f"confirm_delete:{student}"),
             InlineKeyboardButton(text="Отмена", callback_data=f"cancel_delete:{student}")
         ]
     ]
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+    markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
+    _confirm_keyboard_cache[student] = markup
+    return markup
 
 @router.message(Command("edit_students"))
 async def edit_students_command(message: types.Message):
     keyboard = build_students_keyboard()
     await message.reply("Редактирование списка учащихся:", reply_markup=keyboard)
 
-@router.callback_query(lambda c: c.data and c.data.startswith("delete:"))
+@router.callback_query(F.data.startswith("delete:"))
 async def request_delete(callback: types.CallbackQuery):
     student_to_delete = callback.data.split("delete:")[1]
     confirm_keyboard = build_confirm_deletion_keyboard(student_to_delete)
@@ -355,23 +421,23 @@ async def request_delete(callback: types.CallbackQuery):
         reply_markup=confirm_keyboard
     )
 
-@router.callback_query(lambda c: c.data and c.data.startswith("confirm_delete:"))
+@router.callback_query(F.data.startswith("confirm_delete:"))
 async def confirm_delete(callback: types.CallbackQuery):
     student_to_delete = callback.data.split("confirm_delete:")[1]
-    if STUDENTS.remove(student_to_delete):
+    if await STUDENTS.remove(student_to_delete):
         await callback.answer(f"Удалено: {student_to_delete}", show_alert=True)
     else:
         await callback.answer("Студент не найден.", show_alert=True)
     keyboard = build_students_keyboard()
     await callback.message.edit_text("Редактирование списка учащихся:", reply_markup=keyboard)
 
-@router.callback_query(lambda c: c.data and c.data.startswith("cancel_delete:"))
+@router.callback_query(F.data.startswith("cancel_delete:"))
 async def cancel_delete(callback: types.CallbackQuery):
     keyboard = build_students_keyboard()
     await callback.answer("Удаление отменено.", show_alert=True)
     await callback.message.edit_text("Редактирование списка учащихся:", reply_markup=keyboard)
 
-@router.callback_query(lambda c: c.data == "add_student")
+@router.callback_query(F.data == "add_student")
 async def process_add_request(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
     await callback.message.answer("Введите ФИО нового ученика(ов) через запятую:")
@@ -383,7 +449,7 @@ async def add_student_handler(message: types.Message, state: FSMContext):
     if not new_students:
         await message.reply("Список учащихся не может быть пустым. Попробуйте еще раз.")
         return
-    STUDENTS.add(new_students)
+    await STUDENTS.add(new_students)
     await message.reply("Новые ученики успешно добавлены.")
     await state.clear()
     keyboard = build_students_keyboard()
@@ -392,9 +458,12 @@ async def add_student_handler(message: types.Message, state: FSMContext):
 @router.message(Command("stats"))
 async def stats_command(message: types.Message):
     try:
-        cursor = db_manager.conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM schedule_history")
-        schedule_count = cursor.fetchone()[0]
+        # Записи истории не удаляются, поэтому счетчик AUTOINCREMENT равен числу строк.
+        async with db_manager.conn.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'schedule_history'"
+        ) as cursor:
+            row = await cursor.fetchone()
+        schedule_count = row[0] if row else 0
         students_count = len(STUDENTS.get_all())
         response = (
             f"Статистика использования бота:\n"
@@ -406,6 +475,21 @@ async def stats_command(message: types.Message):
         logging.exception("Ошибка при получении статистики.")
         await message.reply("Произошла ошибка при получении статистики.")
 
+def read_log_tail(log_file: str, num_lines: int, block_size: int = 8192) -> List[str]:
+    """
+    Возвращает последние строки лог-файла, читая только его конец.
+    """
+    with open(log_file, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - block_size))
+        tail = f.read().decode("utf-8", errors="ignore")
+    lines = tail.splitlines()
+    if size > block_size:
+        # Первая строка блока, скорее всего, обрезана.
+        lines = lines[1:]
+    return lines[-num_lines:]
+
 @router.message(Command("audit"))
 async def audit_command(message: types.Message):
     try:
@@ -413,10 +497,8 @@ async def audit_command(message: types.Message):
         if not os.path.exists(log_file):
             await message.reply("Файл логов не найден.")
             return
-        with open(log_file, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-        last_lines = lines[-20:] if len(lines) >= 20 else lines
-        text = "Логи последних событий:\n" + "".join(last_lines)
+        last_lines = await asyncio.to_thread(read_log_tail, log_file, 20)
+        text = "Логи последних событий:\n" + "\n".join(last_lines)
         if len(text) > 4000:
             text = text[-4000:]
         await message.reply(text)
@@ -428,10 +510,16 @@ async def audit_command(message: types.Message):
 
 async def main():
     dp = Dispatcher(storage=storage)
-    dp.update.middleware.register(AllowedUsersMiddleware())
-    dp.update.middleware.register(GlobalErrorHandler())
+    # Бот обрабатывает только сообщения и нажатия кнопок, остальные типы событий не проверяются.
+    for observer in (dp.message, dp.callback_query):
+        observer.middleware(AllowedUsersMiddleware())
+        observer.middleware(GlobalErrorHandler())
     dp.include_router(router)
-    await dp.start_polling(bot)
+    try:
+        await init_storage()
+        await dp.start_polling(bot)
+    finally:
+        await db_manager.close()
 
 if __name__ == "__main__":
     try: